@@ -1,4 +1,9 @@
+import heapq
+import mmap
+import os
+import sys
 from enum import Enum
+from operator import itemgetter
 from typing import Optional, Generic
 
 
@@ -7,10 +12,7 @@ class SortOrder(Enum):
     ASC = 2
 
     def __str__(self):
-        if self is SortOrder.ASC:
-            return 'ASC'
-        else:
-            return 'DESC'
+        return self.name
 
 
 class DataType(Enum):
@@ -20,30 +22,28 @@ class DataType(Enum):
     DATETIME = 4,
 
     def __str__(self):
-        if self is DataType.INT:
-            return 'INT'
-        elif self is DataType.CHAR:
-            return 'CHAR'
-        elif self is DataType.VARCHAR:
-            return 'VARCHAR'
-        else:
-            return 'DATETIME'
+        return self.name
 
     @staticmethod
     def from_string(data_type: str):
-        if data_type == 'int':
-            return DataType.INT
-        elif data_type == 'char':
-            return DataType.CHAR
-        elif data_type == 'varchar':
-            return DataType.VARCHAR
-        elif data_type == 'datetime':
-            return DataType.DATETIME
-        else:
-            raise Exception('unknown type:' + data_type)
+        try:
+            return DataType[data_type.upper()]
+        except KeyError:
+            raise Exception('unknown type:' + data_type) from None
+
+
+# 每种类型从bytes字段取值的表达式, 用于TableScan生成扫描代码
+_DECODERS = {
+    DataType.INT: 'int(%s)',
+    DataType.CHAR: '%s.decode()',
+    DataType.VARCHAR: '%s.decode()',
+    DataType.DATETIME: '%s.decode()',
+}
 
 
 class CellMetadata:
+    __slots__ = ('name', 'type', 'size', 'null')
+
     def __init__(self, name, data_type: DataType, value_size: int = 8, is_null: bool = False):
         self.name = name
         self.type = data_type
@@ -54,203 +54,353 @@ class CellMetadata:
         return """%s %s(%d) """ % (self.name, self.type, self.size) + (' NOT NULL' if self.null else ' NULL')
 
 
-class Cell:
-    def __init__(self, cell_value):
-        self.value = cell_value
+class Schema:
+    __slots__ = ('metas', 'names', 'types', 'name_to_idx')
+
+    def __init__(self, metas):
+        self.metas = tuple(metas)
+        self.names = tuple(cmd.name for cmd in self.metas)
+        self.types = tuple(cmd.type for cmd in self.metas)
+        self.name_to_idx = {name: i for i, name in enumerate(self.names)}
+
+    def index(self, name) -> int:
+        if name not in self.name_to_idx:
+            raise Exception('no column named:' + name + ' found')
+        return self.name_to_idx[name]
+
+    def __len__(self):
+        return len(self.metas)
 
     def __str__(self):
-        return """%s""" % (str(self.value))
+        return ','.join(str(cmd) for cmd in self.metas)
 
 
-class Row:
-    def __init__(self, metas, cells):
-        self.metas = metas
-        self.cells = cells
+class Row(tuple):
+    # 行只保存值, 列信息由算子的schema()统一提供
+    __slots__ = ()
 
     def __str__(self):
-        out = ''
-        for i, cell in enumerate(self.cells):
-            out += str(cell.value)
-            out += '\t\t'
-        return out
+        return '\t\t'.join(map(str, self))
 
 
 class RowSet:
+    __slots__ = ('rows',)
+
     def __init__(self, rows):
         self.rows = rows
 
 
 class Operator:
+    __slots__ = ()
+
     def open(self):
         pass
 
     def get_next(self) -> Optional[Row]:
         pass
 
+    def schema(self) -> Schema:
+        pass
+
     def close(self):
         pass
 
 
 class Project(Operator):
+    __slots__ = ('downstream', 'columns', '_schema', '_project')
+
     def __init__(self, downstream, columns):
         self.downstream = downstream
-        self.columns = columns
+        self.columns = [sys.intern(name) for name in columns]
+        self._schema = None
+        self._project = None
 
     def open(self):
         self.downstream.open()
+        # 列映射在open时算好, get_next只做下标取值
+        schema = self.downstream.schema()
+        proj_idx = [schema.index(name) for name in self.columns]
+        self._schema = Schema(schema.metas[i] for i in proj_idx)
+        if len(proj_idx) == 0:
+            self._project = lambda row: ()
+        elif len(proj_idx) == 1:
+            self._project = lambda row, i=proj_idx[0]: (row[i],)
+        else:
+            self._project = itemgetter(*proj_idx)
 
     def close(self):
         self.downstream.close()
 
+    def schema(self) -> Schema:
+        if self._schema is None:
+            schema = self.downstream.schema()
+            return Schema(schema.metas[schema.index(name)] for name in self.columns)
+        return self._schema
+
     def get_next(self) -> Optional[Row]:
         row = self.downstream.get_next()
-        if not row:
+        if row is None:
             return None
-        else:
-            mds = {}
-            for i, v in enumerate(row.metas):
-                cmd = row.metas[i]
-                mds[cmd.name] = (i, cmd, row.cells[i])
-            metas = []
-            cells = []
-            for i, v in enumerate(self.columns):
-                out = mds[self.columns[i]]
-                metas.append(out[1])
-                cells.append(out[2])
-            return Row(metas, cells)
+        return Row(self._project(row))
 
     def __str__(self):
         return """ProjectOp(%s)""" % ','.join(self.columns)
 
 
 class Filter(Operator):
+    __slots__ = ('downstream', 'name', 'value', 'conditions', '_pred')
+
     def __init__(self, downstream: Operator, name, value):
         self.downstream = downstream
-        self.name = name
+        self.name = sys.intern(name)
         self.value = value
+        # AND连接的等值条件, 相邻的Filter会被合并到一起
+        self.conditions = [(self.name, value)]
+        self._pred = None
 
     def open(self):
         self.downstream.open()
+        schema = self.downstream.schema()
+        preds = []
+        for name, value in self.conditions:
+            preds.append((schema.index(name), value))
+        self._pred = Filter._make_pred(preds)
+
+    def schema(self) -> Schema:
+        return self.downstream.schema()
 
     def get_next(self) -> Optional[Row]:
+        pred = self._pred
         while True:
             row = self.downstream.get_next()
             if row is None:
-                break
-            if self.__filter__(row):
+                return None
+            if pred(row):
                 return row
-            else:
-                continue
-        return None
 
     def close(self):
         self.downstream.close()
 
     def __str__(self):
-        return """FilterOp(%s=%s)""" % (str(self.name), str(self.value))
-
-    def __filter__(self, row: Row):
-        index = -1
-        for idx, v in enumerate(row.metas):
-            cmd = row.metas[idx]
-            if cmd.name == self.name:
-                index = idx
-                break
-            else:
-                continue
-        if index == -1:
-            raise Exception('no column named:' + self.name + ' found')
-        cell = row.cells[index]
-        if cell.value == self.value:
-            return True
-        return False
+        return """FilterOp(%s)""" % ' AND '.join('%s=%s' % (str(name), str(value)) for name, value in self.conditions)
+
+    @staticmethod
+    def _make_pred(preds):
+        if len(preds) == 1:
+            index, value = preds[0]
+            return lambda row, i=index, v=value: row[i] == v
+        return lambda row, p=tuple(preds): all(row[i] == v for i, v in p)
+
+
+# 按(列类型, 下推条件的列)缓存生成的扫描函数
+_SCANNERS = {}
+
+
+def _scanner(types: tuple, indexes: tuple):
+    # 为确定的表结构和下推条件生成专用的扫描函数, 条件的值作为参数传入.
+    # _scan返回满足条件的Row, _match只判断是否满足条件; 空行跳过, 列数不对的行报错:
+    # def _make(row_type, v0):
+    #     def _scan(line):
+    #         t = line.split()
+    #         if len(t) != 8:
+    #             if not t:
+    #                 return None
+    #             raise Exception('bad line:' + line.decode())
+    #         c2 = int(t[2])
+    #         if c2 != v0:
+    #             return None
+    #         return row_type((int(t[0]), t[1].decode(), c2, ...))
+    #     def _match(line):
+    #         ...
+    #     return _scan, _match
+    key = (types, indexes)
+    factory = _SCANNERS.get(key)
+    if factory is None:
+        src = ['def _make(row_type%s):' % ''.join(', v%d' % j for j in range(len(indexes)))]
+        for name, miss, hit in (('_scan', 'None', None), ('_match', 'False', 'True')):
+            src.append('    def %s(line):' % name)
+            src.append('        t = line.split()')
+            src.append('        if len(t) != %d:' % len(types))
+            src.append('            if not t:')
+            src.append('                return %s' % miss)
+            src.append("            raise Exception('bad line:' + line.decode())")
+            for j, i in enumerate(indexes):
+                src.append('        c%d = %s' % (i, _DECODERS[types[i]] % ('t[%d]' % i)))
+                src.append('        if c%d != v%d:' % (i, j))
+                src.append('            return %s' % miss)
+            if hit is None:
+                values = ['c%d' % i if i in indexes else _DECODERS[data_type] % ('t[%d]' % i)
+                          for i, data_type in enumerate(types)]
+                hit = 'row_type((%s))' % ''.join(value + ', ' for value in values)
+            src.append('        return %s' % hit)
+        src.append('    return _scan, _match')
+        ns = {}
+        exec('\n'.join(src), ns)
+        factory = ns['_make']
+        _SCANNERS[key] = factory
+    return factory
 
 
 class TableScan(Operator):
+    __slots__ = ('table', 'columns', 'condition', 'metadata', '_schema', '_pushed', '_lines', '_scan', '_match')
+
     def __init__(self, table, columns, condition=None):
         if condition is None:
             condition = []
         self.table = table
         self.columns = columns
+        # 下推的等值条件: [(name, value)]
         self.condition = condition
-        self.file = None
-        self.metadata = {}
+        self.metadata = []
+        self._schema = None
+        self._pushed = []
+        self._lines = iter(())
+        self._scan = None
+        self._match = None
 
     def open(self):
-        self.file = open(self.table + '.txt')
-        md = self.file.readline()
+        # 一次性把整个文件映射进来按行切分, 每行在用到时才解码; 读完文件就可以关闭
+        with open(self.table + '.txt', 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                # 空文件不能mmap
+                self._parse_metadata(b'')
+                self._lines = iter(())
+            else:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    self._parse_metadata(mm.readline())
+                    self._lines = iter(mm[mm.tell():].splitlines())
+        self._pushed = [(self._schema.index(name), value) for name, value in self.condition]
+        factory = _scanner(self._schema.types, tuple(index for index, _ in self._pushed))
+        self._scan, self._match = factory(Row, *[value for _, value in self._pushed])
+
+    def schema(self) -> Schema:
+        # 优化阶段表还没有打开, 只读取表头
+        if self._schema is None:
+            with open(self.table + '.txt', 'rb') as file:
+                self._parse_metadata(file.readline())
+        return self._schema
+
+    def _parse_metadata(self, md):
         # 第一行是空格分割的字符串
         # id:str name:int age:
-        for i, col_def_str in enumerate(md.split()):
+        # 表头按bytes读入, 规划和执行时都用同样的方式解码
+        self.metadata = []
+        for col_def_str in md.decode().split():
             col_def = col_def_str.split(':')
             # id:type:size
-            cmd = CellMetadata(col_def[0], DataType.from_string(col_def[1]), int(col_def[2]))
-            self.metadata[i] = cmd
+            cmd = CellMetadata(sys.intern(col_def[0]), DataType.from_string(col_def[1]), int(col_def[2]))
+            self.metadata.append(cmd)
+        self._schema = Schema(self.metadata)
 
     def get_next(self) -> Optional[Row]:
-        line = self.file.readline()
-        if line is None or line == '':
-            return None
-        cells = []
-        lines = line.split()
-        metadata = {}
-        for i, c in enumerate(lines):
-            md = self.metadata[i]
-            cell_value = self._convert(c, md)
-            cell = Cell(cell_value)
-            cells.append(cell)
-            metadata[i] = md
-        return Row(metadata, cells)
+        scan = self._scan
+        for line in self._lines:
+            # 不满足下推条件的行不需要构造Row
+            row = scan(line)
+            if row is not None:
+                return row
+        return None
+
+    def count(self) -> int:
+        # 只数满足下推条件的行, 不构造Row
+        return sum(map(self._match, self._lines))
 
     def close(self):
-        self.file.close()
+        self._lines = iter(())
 
     def __str__(self):
-        return """TableScanOp(%s,[%s],[%s])""" % (self.table, ",".join(self.columns), ','.join(self.condition))
-
-    @staticmethod
-    def _convert(src, cmd) -> object:
-        if cmd.type is DataType.INT:
-            return int(src)
-        elif cmd.type is DataType.CHAR or cmd.type is DataType.VARCHAR:
-            return str(src)
-        elif cmd.type is DataType.DATETIME:
-            return str(src)
-        else:
-            raise Exception('unknown type:' + str(cmd))
+        return """TableScanOp(%s,[%s],[%s])""" % (self.table, ",".join(self.columns),
+                                                  ','.join('%s=%s' % (str(name), str(value)) for name, value in self.condition))
 
 
 class ScalarAgg(Operator):
+    __slots__ = ()
+
     def __init__(self):
         pass
 
 
+class Count(Operator):
+    __slots__ = ('downstream', '_schema', 'value')
+
+    def __init__(self, downstream: Operator):
+        self.downstream = downstream
+        self._schema = Schema([CellMetadata('count', DataType.INT)])
+        self.value = None
+
+    def open(self):
+        self.downstream.open()
+        if isinstance(self.downstream, TableScan):
+            self.value = self.downstream.count()
+        else:
+            n = 0
+            get_next = self.downstream.get_next
+            while get_next() is not None:
+                n += 1
+            self.value = n
+
+    def close(self):
+        self.value = None
+        self.downstream.close()
+
+    def schema(self) -> Schema:
+        return self._schema
+
+    def get_next(self) -> Optional[Row]:
+        if self.value is None:
+            return None
+        row = Row((self.value,))
+        self.value = None
+        return row
+
+    def __str__(self):
+        return """CountOp(*)"""
+
+
 class Limit(Operator):
+    __slots__ = ('downstream', 'offset', 'limit', 'index', 'closed')
+
     def __init__(self, downstream: Operator, offset: int, limit: int):
         self.downstream = downstream
         self.offset = offset
         self.limit = limit
         self.index = 0
+        self.closed = True
 
     def open(self):
         self.downstream.open()
+        self.closed = False
+        self.index = 0
+        for _ in range(self.offset):
+            if self.downstream.get_next() is None:
+                break
 
     def close(self):
-        self.downstream.close()
+        if not self.closed:
+            self.closed = True
+            self.downstream.close()
+
+    def schema(self) -> Schema:
+        return self.downstream.schema()
 
     def get_next(self) -> Optional[Row]:
+        if self.index >= self.limit:
+            # 达到limit后不再拉取下游, 提前释放下游的资源
+            self.close()
+            return None
         row = self.downstream.get_next()
-        if row is not None and self.index < self.limit:
-            self.index = self.index + 1
-            return row
-        else:
+        if row is None:
             return None
+        self.index = self.index + 1
+        return row
 
     def __str__(self):
         return """LimitOp(%d,%d)""" % (self.offset, self.limit)
 
 
 class Sort(Operator):
+    __slots__ = ('downstream', 'name', 'order', 'index', 'extra')
+
     def __init__(self, downstream, sort_name, sort_order=SortOrder.ASC):
         self.downstream = downstream
         self.name = sort_name
@@ -268,13 +418,20 @@ class Sort(Operator):
             else:
                 self.extra.append(row)
 
-        merge_sort(self.extra, [(self.name, self.order)])
+        index = self.downstream.schema().index(self.name)
+        # list.sort是Timsort: 少于64行时直接做二分插入排序, 已经有序的输入只需一次O(n)扫描,
+        # 不需要再为小输入或有序输入单独写排序
+        # itemgetter取key和元组比较都持有GIL, 分块放到线程池里排序不会更快, 所以这里只排一次
+        self.extra.sort(key=itemgetter(index), reverse=self.order is SortOrder.DESC)
 
     def close(self):
         self.index = 0
         self.extra.clear()
         self.downstream.close()
 
+    def schema(self) -> Schema:
+        return self.downstream.schema()
+
     def get_next(self) -> Optional[Row]:
         if self.index < len(self.extra):
             row = self.extra[self.index]
@@ -285,21 +442,57 @@ class Sort(Operator):
     def __str__(self):
         return """SortOp(%s %s)""" % (self.name, self.order)
 
-    def __compare__(self, lhs: Row, rhs: Row) -> int:
-        self.name = ''
-        return 0
 
+class TopK(Operator):
+    __slots__ = ('downstream', 'name', 'order', 'offset', 'limit', 'index', 'rows')
 
-def merge_sort(rows, sorts):
-    pass
+    def __init__(self, downstream, sort_name, sort_order, offset: int, limit: int):
+        self.downstream = downstream
+        self.name = sort_name
+        self.order = sort_order
+        self.offset = offset
+        self.limit = limit
+        self.index = 0
+        self.rows = []
+
+    def open(self):
+        self.downstream.open()
+        index = self.downstream.schema().index(self.name)
+        # 只保留offset+limit行的堆, 不需要对所有行排序
+        select = heapq.nlargest if self.order is SortOrder.DESC else heapq.nsmallest
+        self.rows = select(self.offset + self.limit, iter(self.downstream.get_next, None),
+                           key=itemgetter(index))
+        self.index = self.offset
+
+    def close(self):
+        self.index = 0
+        self.rows = []
+        self.downstream.close()
+
+    def schema(self) -> Schema:
+        return self.downstream.schema()
+
+    def get_next(self) -> Optional[Row]:
+        if self.index < len(self.rows):
+            row = self.rows[self.index]
+            self.index = self.index + 1
+            return row
+        return None
+
+    def __str__(self):
+        return """TopKOp(%s %s,%d,%d)""" % (self.name, self.order, self.offset, self.limit)
 
 
 class UnaryOp(Operator):
+    __slots__ = ()
+
     def __init__(self, downstream: Operator):
         pass
 
 
 class BinaryOp(Operator):
+    __slots__ = ('lhs', 'opt', 'rhs')
+
     def __init__(self, lhs, opt, rhs):
         self.lhs = lhs
         self.opt = opt
@@ -317,6 +510,48 @@ class DatabaseEngine:
     def __init__(self):
         pass
 
+    def optimize(self, op: Operator) -> Operator:
+        if isinstance(op, Filter):
+            # 把连续的Filter合并为一个, 条件按原来由内到外的顺序求值
+            filters = []
+            while isinstance(op, Filter):
+                filters.append(op)
+                op = op.downstream
+            filters.reverse()
+            fused = Filter(self.optimize(op), filters[0].name, filters[0].value)
+            fused.conditions = [cond for f in filters for cond in f.conditions]
+            # 选择性高的条件先求值, 后面的条件就只需要检查更少的行
+            schema = fused.schema()
+            types = dict(zip(schema.names, schema.types))
+            fused.conditions.sort(key=lambda cond: DatabaseEngine._selectivity(types.get(cond[0])))
+            fused.name, fused.value = fused.conditions[0]
+            if isinstance(fused.downstream, TableScan):
+                return DatabaseEngine._push_down(fused, fused.downstream)
+            return fused
+        if isinstance(op, Limit) and isinstance(op.downstream, Sort):
+            # Limit(Sort(x)) => TopK(x)
+            sort = op.downstream
+            return TopK(self.optimize(sort.downstream), sort.name, sort.order, op.offset, op.limit)
+        if hasattr(op, 'downstream'):
+            op.downstream = self.optimize(op.downstream)
+        return op
+
+    @staticmethod
+    def _push_down(op: Filter, scan: TableScan) -> Operator:
+        # 把能在TableScan上求值的条件下推, 不认识的列留给Filter报错
+        names = scan.schema().name_to_idx
+        scan.condition = scan.condition + [cond for cond in op.conditions if cond[0] in names]
+        op.conditions = [cond for cond in op.conditions if cond[0] not in names]
+        if not op.conditions:
+            return scan
+        op.name, op.value = op.conditions[0]
+        return op
+
+    @staticmethod
+    def _selectivity(data_type: DataType) -> int:
+        # 没有统计信息, INT上的等值条件通常比字符串上的更有选择性
+        return 0 if data_type is DataType.INT else 1
+
     def table_scan(self):
         pass
 
@@ -329,6 +564,7 @@ if __name__ == '__main__':
     op = Filter(op, 'addr', 'sh')
     op = Limit(op, 0, 5)
     op = Project(op, ['name', 'addr', 'mobile_no'])
+    op = DatabaseEngine().optimize(op)
     op.open()
     while True:
         r = op.get_next()